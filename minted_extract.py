@@ -5,8 +5,6 @@
 # Originally inspired by https://tex.stackexchange.com/a/130755
 from __future__ import annotations
 
-import re
-import collections
 import argparse
 import pathlib
 import enum
@@ -22,8 +20,16 @@ class Token(enum.Enum):
     HL_END = "!>"
 
 
-TOKEN_PAT = r"|".join(re.escape(token.value) for token in Token)
-COMMENT_RE = re.compile(rf"(?P<code>.*) +# (?P<comment>({TOKEN_PAT}) .*)")
+# What a token comment starts with, i.e. the part after "# "
+TOKEN_STARTS = tuple(f"{token.value} " for token in Token)
+TOKEN_BY_VALUE = {token.value: token for token in Token}
+
+
+# Printed after each snippet in --batch mode, so the output can be split again
+BATCH_SEPARATOR = "% minted-extract: end of snippet"
+
+# Cleaned code lines, and mapping snippet name to list of (lineno, token)
+ParsedFile = tuple[list[str], dict[str, list[tuple[int, Token]]]]
 
 
 class Error(Exception):
@@ -40,9 +46,21 @@ def parse_args() -> argparse.Namespace:
         type=lambda v: bool(int(v)),
         choices=[0, 1],
     )
-    parser.add_argument("file", help="Source file to read", type=pathlib.Path)
-    parser.add_argument("snippet", help="Snippet name to extract")
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch",
+        help="Read tab-separated 'FILE SNIPPET' lines from stdin and extract all",
+        action="store_true",
+    )
+    parser.add_argument(
+        "file", help="Source file to read", type=pathlib.Path, nargs="?"
+    )
+    parser.add_argument("snippet", help="Snippet name to extract", nargs="?")
+    args = parser.parse_args()
+    if args.batch and args.file is not None:
+        parser.error("file/snippet can't be given with --batch")
+    elif not args.batch and (args.file is None or args.snippet is None):
+        parser.error("file and snippet are required")
+    return args
 
 
 def tokens_to_minted_opts(
@@ -89,72 +107,122 @@ def tokens_to_minted_opts(
         raise Error(f"Missing start/end tokens in {tokens} for {snippet}")
 
 
-def expand_snippet_name(snippet: str) -> Iterator[str]:
+def expand_snippet_name(snippet: str) -> list[str]:
     """Handle snippet names like `code-changes-[345]`."""
-    if "[" not in snippet:
-        yield snippet
-        return
+    prefix, bracket, rest = snippet.partition("[")
+    if not bracket:
+        return [snippet]
 
-    start_idx = snippet.index("[")
-    end_idx = snippet.index("]")
-    prefix = snippet[:start_idx]
-    suffix = snippet[end_idx + 1 :]
-    for part in snippet[start_idx + 1 : end_idx]:
-        yield prefix + part + suffix
+    chars, bracket, suffix = rest.partition("]")
+    if not bracket:
+        raise Error(f"Missing ] in snippet name {snippet}")
+    return [prefix + char + suffix for char in chars]
 
 
 def split_line(line: str) -> tuple[str, str | None]:
-    m = COMMENT_RE.match(line)
-    if m is None:
-        return line, None
+    # The last " # " followed by a token starts the comment. Like the regex
+    # "(.*) +# (token) .*" this was replaced with, only a single space before
+    # the "#" is taken away from the code.
+    idx = line.rfind(" # ")
+    while idx != -1:
+        if line.startswith(TOKEN_STARTS, idx + 3):
+            return line[:idx], line[idx + 3 :]
+        idx = line.rfind(" # ", 0, idx)
 
-    return m.group("code"), m.group("comment")
+    return line, None
 
 
-def main() -> None:
-    args = parse_args()
-    # print(r"\begin{minted}{python}")
-    # for a in sys.argv:
-    #    print(repr(a))
-    # print(r"\end{minted}")
-
-    with open(args.file) as f:
-        lines = f.read().splitlines()
-
-    clean_lines = []
-    minted_opts = args.minted_opts.split(",") if args.minted_opts else []
+def parse_file(path: pathlib.Path) -> ParsedFile:
+    clean_lines: list[str] = []
 
     # Mapping snippet name to list of (lineno, token)
-    tokens: dict[str, list[tuple[int, Token]]] = collections.defaultdict(list)
-
-    for lineno, line in enumerate(lines, start=1):
-        code, comment = split_line(line)
-        clean_lines.append(code)
-        if comment is None:
-            continue
+    tokens: dict[str, list[tuple[int, Token]]] = {}
 
-        for part in comment.split(";"):
-            token_str, snippet_pat = part.strip().split(" ", 1)
-            try:
-                token = Token(token_str)
-            except ValueError:
-                raise Error(f"Unknown token: {token_str}")
-            for snippet in expand_snippet_name(snippet_pat):
-                tokens[snippet].append((lineno, token))
+    clean_lines_append = clean_lines.append
+    try:
+        with open(path, encoding="utf-8", buffering=65536) as f:
+            for lineno, line in enumerate(f, start=1):
+                code, comment = split_line(line.rstrip("\n"))
+                clean_lines_append(code)
+                if comment is None:
+                    continue
+
+                for part in comment.split(";"):
+                    token_str, _, snippet_pat = part.strip().partition(" ")
+                    if not snippet_pat:
+                        raise Error(f"Missing snippet name at line {lineno}")
+                    token = TOKEN_BY_VALUE.get(token_str)
+                    if token is None:
+                        raise Error(f"Unknown token: {token_str}")
+                    for snippet in expand_snippet_name(snippet_pat):
+                        tokens.setdefault(snippet, []).append((lineno, token))
+    except (OSError, UnicodeDecodeError) as e:
+        raise Error(f"Can't read {path}: {e}")
 
     # print(dict(tokens))
+    return clean_lines, tokens
 
-    if args.snippet:  # empty arg: full file
-        minted_opts += list(tokens_to_minted_opts(tokens[args.snippet], args.snippet))
 
+def print_snippet(
+    args: argparse.Namespace, path: pathlib.Path, snippet: str, parsed: ParsedFile
+) -> None:
+    clean_lines, tokens = parsed
+    minted_opts = args.minted_opts.split(",") if args.minted_opts else []
+
+    if snippet:  # empty arg: full file
+        minted_opts += list(tokens_to_minted_opts(tokens.get(snippet, []), snippet))
+
+    out = []
     if args.show_name:
-        name = args.file.relative_to(pathlib.PurePath("code"))
-        print(r"\filenameheader{%s}" % name)
+        try:
+            name = path.relative_to(pathlib.PurePath("code"))
+        except ValueError:
+            raise Error(f"{path} is not in code/, can't show its name")
+        out.append(r"\filenameheader{%s}" % name)
 
     minted_opts_str = ",".join(minted_opts)
-    print(r"\begin{minted}[%s]{%s}" % (minted_opts_str, args.minted_lang))
-    print("\n".join(clean_lines))
-    print(r"\end{minted}")
+    out.append(r"\begin{minted}[%s]{%s}" % (minted_opts_str, args.minted_lang))
+    out.append("\n".join(clean_lines))
+    out.append(r"\end{minted}")
+    out.append("")  # trailing newline
+    sys.stdout.write("\n".join(out))
+
+
+def run_batch(args: argparse.Namespace) -> None:
+    """Extract many snippets in one process, parsing each file only once."""
+    parsed_files: dict[pathlib.Path, ParsedFile] = {}
+    failed = False
+
+    for request in sys.stdin:
+        if not request.strip():
+            continue
+        # Tab-separated, as both file names and snippet names can contain spaces
+        file_str, _, snippet = request.rstrip("\r\n").partition("\t")
+        path = pathlib.Path(file_str)
+        try:
+            if path not in parsed_files:
+                parsed_files[path] = parse_file(path)
+            print_snippet(args, path, snippet.strip(), parsed_files[path])
+        except Error as e:
+            print(r"\errmessage{%s}" % e)
+            failed = True
+        print(BATCH_SEPARATOR)
+
+    if failed:
+        sys.exit(1)
+
+
+def main() -> None:
+    args = parse_args()
+    # print(r"\begin{minted}{python}")
+    # for a in sys.argv:
+    #    print(repr(a))
+    # print(r"\end{minted}")
+
+    if args.batch:
+        run_batch(args)
+    else:
+        print_snippet(args, args.file, args.snippet, parse_file(args.file))
 
 
 if __name__ == "__main__":
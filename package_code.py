@@ -3,12 +3,19 @@
 This creates a .zip file from all files in code/ in the development repository
 (i.e. where you'd also have your .tex files), but with all comments stripped
 off.
+
+If pygit2 is installed, it's used to list the files tracked in code/; otherwise,
+this falls back to running "git ls-files code".
 """
 
 import argparse
+import collections
+import concurrent.futures
+import os
 import pathlib
 import subprocess
 import zipfile
+from typing import Iterable, Iterator
 
 import minted_extract
 
@@ -16,13 +23,37 @@ import minted_extract
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Package code for participants")
     parser.add_argument("filename", help="Output filename", type=pathlib.Path)
+    parser.add_argument(
+        "--jobs",
+        help="Number of files to process in parallel",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
     args = parser.parse_args()
     if args.filename.suffix != ".zip":
         parser.error("Output filename must have .zip extension")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
     return args
 
 
 def get_code_files() -> list[pathlib.Path]:
+    try:
+        import pygit2  # type: ignore[import-not-found]
+    except ImportError:
+        return get_code_files_subprocess()
+
+    # Read the git index in-process, without spawning git.
+    repo = pygit2.Repository(".")
+    cwd = pathlib.Path.cwd().relative_to(pathlib.Path(repo.workdir).resolve())
+    return [
+        pathlib.Path(entry.path).relative_to(cwd)
+        for entry in repo.index
+        if pathlib.Path(entry.path).is_relative_to(cwd / "code")
+    ]
+
+
+def get_code_files_subprocess() -> list[pathlib.Path]:
     proc = subprocess.run(
         ["git", "ls-files", "code"], capture_output=True, text=True, check=True
     )
@@ -30,28 +61,69 @@ def get_code_files() -> list[pathlib.Path]:
     return [pathlib.Path(p) for p in proc.stdout.splitlines()]
 
 
-def process_file(path: pathlib.Path) -> str:
-    cleaned_lines = []
-    with path.open("r") as src:
-        for line in src:
-            cleaned, _comment = minted_extract.split_line(line.rstrip())
-            cleaned_lines.append(cleaned)
+def clean_lines(path: pathlib.Path) -> str:
+    split_line = minted_extract.split_line
+    with path.open("r", encoding="utf-8") as src:
+        stripped = (line.rstrip() for line in src)
+        # Only lines containing " # " can have a token comment
+        cleaned_lines = [
+            split_line(line)[0] if " # " in line else line for line in stripped
+        ]
 
     return "\n".join(cleaned_lines)
 
 
-def make_zip(files: dict[pathlib.Path, str], out_path: pathlib.Path) -> None:
-    with zipfile.ZipFile(out_path, "w") as zipf:
-        for file_path, contents in files.items():
-            print(file_path)
-            zipf.writestr(str(file_path), contents)
+def process_file(path: pathlib.Path) -> bytes:
+    return clean_lines(path).encode("utf-8")
+
+
+def make_zip(
+    files: Iterable[tuple[pathlib.Path, bytes]], out_path: pathlib.Path
+) -> None:
+    # files is consumed lazily and can fail half-way through, so only replace
+    # out_path once the whole archive has been written.
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    try:
+        with zipfile.ZipFile(
+            tmp_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6
+        ) as zipf:
+            for file_path, contents in files:
+                print(file_path)
+                zipf.writestr(str(file_path), contents)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    tmp_path.replace(out_path)
+
+
+def process_all(
+    code_files: list[pathlib.Path], jobs: int
+) -> Iterator[tuple[pathlib.Path, bytes]]:
+    if jobs == 1 or len(code_files) < jobs:
+        # Not worth starting worker processes for
+        for file in code_files:
+            yield file, process_file(file)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Only keep a couple of files per worker in flight, so finished results
+        # don't pile up in memory if writing the zip is slower than processing.
+        pending: collections.deque[
+            tuple[pathlib.Path, concurrent.futures.Future[bytes]]
+        ] = collections.deque()
+        for file in code_files:
+            pending.append((file, executor.submit(process_file, file)))
+            if len(pending) >= 2 * jobs:
+                done_file, future = pending.popleft()
+                yield done_file, future.result()
+        for done_file, future in pending:
+            yield done_file, future.result()
 
 
 def main() -> None:
     args = parse_args()
     code_files = get_code_files()
-    processed = {file: process_file(file) for file in code_files}
-    make_zip(processed, args.filename)
+    make_zip(process_all(code_files, args.jobs), args.filename)
 
 
 if __name__ == "__main__":